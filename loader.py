@@ -31,19 +31,47 @@
 # The AppControl class includes a pair of buttons; one for stopping the arduino, 
 # and one for exiting the application.
 
+# taken before anything else is imported, so --profile-startup can report
+# how long the imports themselves take
+import timeit
+_startupStart = timeit.default_timer()
+
 from Tkinter import *
-import tkFileDialog
-import tkMessageBox
 import ttk
 
-import serial 
+# serial and tkMessageBox are imported where they are first needed; serial
+# is opened in the background and tkMessageBox only shows errors
 import json
+import re
 import time
-import timeit
 import datetime
+import threading
 
 from optparse import OptionParser
 
+def ShowError( title, message ):
+	import tkMessageBox
+	tkMessageBox.showerror( title, message )
+
+# StartupProfiler reports how long each phase of startup takes when the
+# loader is run with --profile-startup. Each mark prints the time since the
+# previous mark and since the script started. Work done in the background
+# is reported with its own duration and doesn't count as a mark.
+class StartupProfiler( object ):
+	def __init__( self, enabled ):
+		self._enabled = enabled
+		self._last = _startupStart
+
+	def Mark( self, phase ):
+		now = timeit.default_timer()
+		self.Report( phase, now - self._last )
+		self._last = now
+
+	def Report( self, phase, elapsed ):
+		now = timeit.default_timer()
+		if( self._enabled ):
+			print "startup: %-22s %8.1f ms   (at %8.1f ms)" % ( phase, elapsed * 1000, ( now - _startupStart ) * 1000 )
+
 class AppControl( object ):
 	def __init__( self, root, arduinoCmds, arduinoLink ):
 		self._arduinoCmds = arduinoCmds
@@ -64,12 +92,16 @@ class AppControl( object ):
 # ArduinoLink encapsulates the serial port connection and the 
 # trace control.
 class ArduinoLink( object ):
-	def __init__( self, root, arduinoCmds, logFileName, debug ): 
+	def __init__( self, root, arduinoCmds, logFileName, debug, profiler ): 
 		self._root = root
 		self._debug = debug
 		self._logFileName = logFileName
+		self._profiler = profiler
 
 		self._conn = None
+		self._connReady = False
+		self._connResult = None
+		self._pending = []
 		self._trace = None
 
 		self._loaderControl = None
@@ -78,22 +110,162 @@ class ArduinoLink( object ):
 
 		self._timer = 0
 		self._timerActive = False
+
+		self._baud = int( arduinoCmds["com"]["baud"] )
+		self._wireTime = 0.0
 		
+		# opening the port, and waiting out the arduino reset and any baud
+		# negotiation, happens on a worker thread so the window can paint
+		# in the meantime. The result is picked up on the Tk thread.
+		if( debug == False ):
+			worker = threading.Thread( target=self._OpenPort, args=( arduinoCmds["com"], ))
+			worker.daemon = True
+			worker.start()
+			self._root.after( 50, self._PollOpenPort )
+
+		self._trace = TraceControl( root )
+
+	# runs on the worker thread; must not touch any Tk objects
+	def _OpenPort( self, comCfg ):
+		start = timeit.default_timer()
+		linkOk = True
+		msg = None
 		try:
-			if( debug == False ):
-				self._conn = serial.Serial( arduinoCmds["com"]["port0"], 
-					int( arduinoCmds["com"]["baud"]), timeout=float( arduinoCmds["com"]["timeout"]))
-		except:
+			import serial
 			try:
-				self._conn = serial.Serial( arduinoCmds["com"]["port1"], 
-					int( arduinoCmds["com"]["baud"]), timeout=float( arduinoCmds["com"]["timeout"]))
-
+				self._conn = serial.Serial( comCfg["port0"], 
+					int( comCfg["baud"]), timeout=float( comCfg["timeout"]))
 			except:
-				tkMessageBox.showerror("Error", "Can't open serial port")
-				print "Error opening com port:", sys.exc_info()[0]
-				raise 
+				self._conn = serial.Serial( comCfg["port1"], 
+					int( comCfg["baud"]), timeout=float( comCfg["timeout"]))
 
-		self._trace = TraceControl( root )
+			if( comCfg.get( "fastBaud" ) != None ):
+				linkOk, msg = self.NegotiateBaud( comCfg )
+		except:
+			print "Error opening com port:", sys.exc_info()[0]
+			self._connResult = ( False, "Can't open serial port", timeit.default_timer() - start )
+			return
+
+		self._connResult = ( linkOk, msg, timeit.default_timer() - start )
+
+	def _PollOpenPort( self ):
+		if( self._connResult == None ):
+			self._root.after( 50, self._PollOpenPort )
+			return
+
+		ok, info, elapsed = self._connResult
+		self._profiler.Report( 'open serial port', elapsed )
+		if( not ok ):
+			ShowError("Error", info)
+			sys.exit( 1 )
+
+		self._connReady = True
+		if( info != None ):
+			self._TraceLine( info )
+
+		# send anything the operator issued while the port was opening
+		pending = self._pending
+		self._pending = []
+		for cmd, extra in pending:
+			self.Send( cmd, extra )
+
+	# NegotiateBaud asks the firmware to move the link to a faster baud rate.
+	# It returns whether the link is usable, and a line describing the
+	# outcome for the trace window (or the error dialog when it isn't).
+	# The request goes out at the current rate as "<baudcmd> <rate>=" and is
+	# repeated until the firmware acknowledges it by echoing the rate back,
+	# since an arduino that was reset by opening the port drops anything sent
+	# while its bootloader runs. Both ends then switch, and _ConfirmLink checks
+	# that the firmware can be heard at the new rate. If that fails the host
+	# goes back to the configured rate and confirms the firmware is there too.
+	# If it isn't, the firmware is taken to be stuck at the new rate, so it is
+	# told at that rate to go back to the configured one; if that doesn't
+	# bring it back the link has failed.
+	def NegotiateBaud( self, comCfg ):
+		baseBaud = self._baud
+		fastBaud = int( comCfg["fastBaud"] )
+		timeout = float( comCfg.get( "handshakeTimeout", "2.5" ))
+		request = comCfg.get( "baudcmd", "B" ) + ' ' + str( fastBaud )
+
+		if( fastBaud <= baseBaud ):
+			return ( True, None )
+
+		if( not self._Handshake( request, str( fastBaud ), timeout )):
+			self._conn.flushInput()
+			return ( True, '--- firmware did not accept %d baud, staying at %d' % ( fastBaud, baseBaud ))
+
+		time.sleep( 0.05 )
+		self._conn.baudrate = fastBaud
+		self._conn.flushInput()
+		if( self._ConfirmLink( comCfg, fastBaud, timeout )):
+			self._baud = fastBaud
+			return ( True, '--- link running at %d baud' % ( fastBaud ))
+
+		self._conn.baudrate = baseBaud
+		self._conn.flushInput()
+		if( self._ConfirmLink( comCfg, baseBaud, timeout )):
+			return ( True, '--- firmware not heard at %d baud, staying at %d' % ( fastBaud, baseBaud ))
+
+		self._conn.baudrate = fastBaud
+		self._conn.flushInput()
+		self._Handshake( comCfg.get( "baudcmd", "B" ) + ' ' + str( baseBaud ), str( baseBaud ), timeout )
+		time.sleep( 0.05 )
+		self._conn.baudrate = baseBaud
+		self._conn.flushInput()
+		if( self._ConfirmLink( comCfg, baseBaud, timeout )):
+			return ( True, '--- firmware recovered from %d baud, staying at %d' % ( fastBaud, baseBaud ))
+		return ( False, 'Serial link failure: firmware not heard at %d or %d baud' % ( fastBaud, baseBaud ))
+
+	# checks that the firmware answers at the host's current baud rate. At a
+	# mismatched rate the host still reads framing garbage, so any reply is
+	# not enough: with com.statusreply set, the status reply must contain it,
+	# otherwise the baud command for this rate must be echoed back.
+	def _ConfirmLink( self, comCfg, baud, timeout ):
+		statusReply = comCfg.get( "statusreply" )
+		if( statusReply != None ):
+			ok = self._Handshake( comCfg.get( "statuscmd", "STA" ), statusReply, timeout )
+		else:
+			ok = self._Handshake( comCfg.get( "baudcmd", "B" ) + ' ' + str( baud ), str( baud ), timeout )
+		self._conn.flushInput()
+		return ok
+
+	# sends cmd until a reply arrives that contains expect, giving up after
+	# timeout seconds
+	def _Handshake( self, cmd, expect, timeout ):
+		reply = ''
+		deadline = timeit.default_timer() + timeout
+		while( timeit.default_timer() < deadline ):
+			try:
+				self._conn.write(( cmd + '=' ).encode())
+				time.sleep( 0.25 )
+				bytesToRead = self._conn.inWaiting()
+				if bytesToRead > 0:
+					reply += self._conn.read( bytesToRead )
+			except:
+				print "Error negotiating baud rate:", sys.exc_info()[0]
+				return False
+
+			if( expect in reply ):
+				return True
+		return False
+
+	# EstimateWireTime returns the seconds it takes to clock cmd, with its
+	# '=' terminator, out of the serial port at the current baud rate. Each
+	# character costs a start bit, the data bits, any parity bit and the
+	# stop bits; 8N1 framing is assumed when there is no open port.
+	def EstimateWireTime( self, cmd ):
+		bitsPerChar = 10.0
+		if( self._connReady ):
+			bitsPerChar = 1 + self._conn.bytesize + self._conn.stopbits
+			if( self._conn.parity != 'N' ):
+				bitsPerChar += 1
+		return ( len( cmd ) + 1 ) * bitsPerChar / self._baud
+
+	def _TraceLine( self, text ):
+		self._trace._textwidget.config( state='normal' )
+		self._trace._textwidget.insert( END, text + '\n' )
+		self._trace._textwidget.see( END )
+		self._trace._textwidget.config( state='disabled' )
 
 	def DisableUiControls( self ):
 		self._loaderControl.Disable()
@@ -114,11 +286,11 @@ class ArduinoLink( object ):
 
 	def Tick( self ):
 		# see if the arduino has written anything to the serial port
-		if( self._debug == False ):
+		if( self._connReady ):
 			try:
 				bytesToRead = self._conn.inWaiting()
 			except:
-				tkMessageBox.showerror("Error", "Serial connection broken.")
+				ShowError("Error", "Serial connection broken.")
 				print "Error opening com port:", sys.exc_info()[0]
 				raise
 
@@ -165,6 +337,18 @@ class ArduinoLink( object ):
 		self._timerActive = True
 
 	def Send( self, cmd, extra=None ):
+		# the port is still being opened; hold the command until it is
+		if(( self._debug == False ) and ( self._connReady == False )):
+			self._pending.append(( cmd, extra ))
+			self._TraceLine( '--- ' + cmd + ' queued until the serial port is open' )
+			return
+
+		# estimate how long the command will spend on the wire, and keep a
+		# running total for the session
+		wireTime = self.EstimateWireTime( cmd )
+		self._wireTime += wireTime
+		wireStr = ' [%.1f ms @ %d baud, %.1f ms total]' % ( wireTime * 1000, self._baud, self._wireTime * 1000 )
+
 		# Log commands to the arduino 
 		if( extra != None ):
 			logEntry = ''.join([ datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f "), cmd + extra ])
@@ -183,7 +367,7 @@ class ArduinoLink( object ):
 		logStr += '='
 
 		# write the command to the trace window
-		self._trace._textwidget.insert( END, '>>>' + logStr + '\n' )
+		self._trace._textwidget.insert( END, '>>>' + logStr + wireStr + '\n' )
 
 		if( self._debug == False ):
 			# write the command to the arduino
@@ -191,7 +375,7 @@ class ArduinoLink( object ):
 				cmd += '='
 				self._conn.write( cmd.encode())
 			except:
-				tkMessageBox.showerror("Error", "Write failed. Serial connection broken.")
+				ShowError("Error", "Write failed. Serial connection broken.")
 				print "Error opening com port:", sys.exc_info()[0]
 				raise
 
@@ -223,23 +407,10 @@ class LoaderControl( object ):
 		btnStatus = Button( self._lfrm, text='Status', height=2, width=18, 
 			command=lambda: self.onStatusButtonClick( ))
 
-		try:
-			with open('/usr/local/cfg/psdProfiles') as pfile:
-				self._profiles = json.load(pfile)
-		except:
-			# json file with profile definitions was not found
-			print "Error opening motor profiles"
-			raise
-
-		profTuples = ()
-		for p in self._profiles['profile']:
-			profTuples += (p['label'],)
-
+		# the profiles are filled in by LoadProfiles once the window is up
 		self._box_value = StringVar()
 
 		self._cbox = ttk.Combobox( self._lfrm, textvariable=self._box_value, width=13, font=( 'Calibri', 12))
-		self._cbox['values'] = profTuples
-		self._cbox.current(0)
 		self._cbox.state(['readonly'])
 
 		btnLoad = Button( self._lfrm, text='Load', height=2, width=18, command=lambda: self.btnLoad_click( ))
@@ -252,6 +423,22 @@ class LoaderControl( object ):
 		btnLoad.grid      ( row=1, column=1 )
 		btnGo.grid        ( row=2, column=1 )
 
+	def LoadProfiles( self ):
+		try:
+			with open('/usr/local/cfg/psdProfiles') as pfile:
+				self._profiles = json.load(pfile)
+		except:
+			# json file with profile definitions was not found
+			print "Error opening motor profiles"
+			raise
+
+		profTuples = ()
+		for p in self._profiles['profile']:
+			profTuples += (p['label'],)
+
+		self._cbox['values'] = profTuples
+		self._cbox.current(0)
+
 	def onFindNeedleButtonClick( self ):
 		self._arduinoLink.Send( self._arduinoCmds["loadcmds"]["findneedle"] )
 
@@ -305,8 +492,232 @@ class LoaderControl( object ):
 	def setLoginControl( self, logCtl ):
 		self._loginControl = logCtl
 
+# Checksum validators for the barcode symbologies the scanners are set up
+# to read. Each takes the complete barcode string, check character included,
+# and returns True if the check character is correct.
+def _LuhnValid( code ):
+	if( not code.isdigit() ):
+		return False
+	total = 0
+	for i, c in enumerate( reversed( code )):
+		d = int( c )
+		if( i % 2 == 1 ):
+			d *= 2
+			if( d > 9 ):
+				d -= 9
+		total += d
+	return ( total % 10 ) == 0
+
+_MOD43_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ-. $/+%'
+
+def _Mod43Valid( code ):
+	if(( len( code ) < 2 ) or ( [ c for c in code if c not in _MOD43_CHARS ] )):
+		return False
+	total = sum( _MOD43_CHARS.index( c ) for c in code[:-1] )
+	return _MOD43_CHARS[ total % 43 ] == code[-1]
+
+BARCODE_CHECKSUMS = {
+	"none"  : lambda code: True,
+	"luhn"  : _LuhnValid,
+	"mod43" : _Mod43Valid
+}
+
+# ScannerConfig collects the barcode scanner settings from the "scanner"
+# section of psdCommands. Older command files only carry "barcodeLen", so
+# that is used as the length range when the scanner section is missing.
+class ScannerConfig( object ):
+	def __init__( self, arduinoCmds ):
+		cfg = arduinoCmds.get( "scanner", {} )
+		barcodeLen = arduinoCmds.get( "barcodeLen", "10" )
+
+		self.minLen = int( cfg.get( "minLen", barcodeLen ))
+		self.maxLen = int( cfg.get( "maxLen", barcodeLen ))
+		self.keyGap = float( cfg.get( "keyGap", "0.03" ))
+		self.burstGap = float( cfg.get( "burstGap", "0.25" ))
+		self.checksum = cfg.get( "checksum", "none" )
+		self.port = cfg.get( "port", None )
+		self.baud = int( cfg.get( "baud", "9600" ))
+
+		if( self.checksum not in BARCODE_CHECKSUMS ):
+			print "Unknown barcode checksum", self.checksum, "- checksums disabled"
+			self.checksum = "none"
+
+# BarcodeScanner tells a keyboard-wedge barcode scanner apart from a person
+# typing into an entry widget. Keystrokes are collected into bursts; a burst
+# ends on a terminator key (Return or Tab, which most scanners append) or
+# when no key arrives for a while. A burst counts as a scan when its median
+# inter-key gap is under the threshold, its length is within range and the
+# checksum passes. The completed barcode is handed to onScan in one call.
+# A burst that is fast enough to be a scan but fails the length or checksum
+# test is a misread; it is handed to onReject along with the reason. Short
+# fast bursts are left alone, since two keys rolled over by hand look the
+# same as the start of a scan.
+#
+# The threshold adapts: it sits at the geometric mean of the running average
+# gaps seen for scans and for hand typing, so it settles between the two for
+# whichever scanner and operator are at the instrument.
+class BarcodeScanner( object ):
+	TERMINATORS = ( 'Return', 'KP_Enter', 'Tab' )
+
+	# scanners press Shift for capitals and shifted symbols, so modifiers
+	# are part of a burst rather than a sign of hand editing
+	MODIFIERS = ( 'Shift_L', 'Shift_R', 'Control_L', 'Control_R', 'Alt_L', 'Alt_R',
+		'Meta_L', 'Meta_R', 'Super_L', 'Super_R', 'Caps_Lock', 'Num_Lock', 'ISO_Level3_Shift' )
+
+	# fewest characters a fast burst needs before a failed check is reported
+	MIN_REJECT_LEN = 4
+
+	def __init__( self, root, scannerConfig, onScan, onReject ):
+		self._root = root
+		self._cfg = scannerConfig
+		self._onScan = onScan
+		self._onReject = onReject
+
+		# seeded so their geometric mean starts out at keyGap
+		self._scanGap = scannerConfig.keyGap / 3.0
+		self._typedGap = scannerConfig.keyGap * 3.0
+		self._threshold = scannerConfig.keyGap
+
+		self._afterId = None
+		self.Reset()
+
+	def Reset( self ):
+		if( self._afterId != None ):
+			self._root.after_cancel( self._afterId )
+			self._afterId = None
+		self._chars = []
+		self._times = []
+
+	def Threshold( self ):
+		return self._threshold
+
+	# bound to <KeyPress> on an entry widget
+	def OnKey( self, event ):
+		# the X server timestamp is taken when the key arrives, so it is not
+		# skewed by however long Tk takes to get round to this handler
+		if( event.time ):
+			now = event.time / 1000.0
+		else:
+			now = timeit.default_timer()
+
+		if( event.keysym in self.MODIFIERS ):
+			return None
+
+		if( event.keysym in self.TERMINATORS ):
+			if( self._chars and self._EndBurst( True ) ):
+				# swallow the terminator so Tab doesn't move focus again
+				return 'break'
+			return None
+
+		if(( len( event.char ) != 1 ) or ( event.char < ' ' )):
+			# editing keys mean a person is at the keyboard
+			self.Reset()
+			return None
+
+		if( self._times and ( now - self._times[-1] ) > self._cfg.burstGap ):
+			self.Reset()
+
+		self._chars.append( event.char )
+		self._times.append( now )
+
+		# scanners that don't send a terminator end their burst by going quiet
+		if( self._afterId != None ):
+			self._root.after_cancel( self._afterId )
+		idleMs = int( max( self._threshold * 4, 0.05 ) * 1000 )
+		self._afterId = self._root.after( idleMs, self._OnIdle )
+		return None
+
+	def _OnIdle( self ):
+		self._afterId = None
+		if( self._chars ):
+			self._EndBurst( False )
+
+	def _EndBurst( self, terminated ):
+		code = ''.join( self._chars )
+		gaps = sorted( b - a for a, b in zip( self._times, self._times[1:] ))
+		self.Reset()
+
+		if( not gaps ):
+			return False
+
+		medianGap = gaps[ len( gaps ) // 2 ]
+		if( medianGap >= self._threshold ):
+			self._Learn( typedGap=medianGap )
+			return False
+
+		# a burst that ended on the scanner's terminator, or is about as long
+		# as a barcode, was a scan; anything shorter is most likely typing
+		plausible = (( len( code ) >= self.MIN_REJECT_LEN )
+			and ( terminated or ( len( code ) >= self._cfg.minLen - 2 )))
+
+		if(( len( code ) < self._cfg.minLen ) or ( len( code ) > self._cfg.maxLen )):
+			if( plausible ):
+				self._onReject( code, 'length %d not in %d-%d' % ( len( code ), self._cfg.minLen, self._cfg.maxLen ))
+			return plausible
+
+		if( not BARCODE_CHECKSUMS[ self._cfg.checksum ]( code )):
+			self._onReject( code, self._cfg.checksum + ' checksum failed' )
+			return True
+
+		self._Learn( scanGap=medianGap )
+		self._onScan( code )
+		return True
+
+	def _Learn( self, scanGap=None, typedGap=None ):
+		if( scanGap != None ):
+			self._scanGap = 0.8 * self._scanGap + 0.2 * scanGap
+		if( typedGap != None ):
+			self._typedGap = 0.8 * self._typedGap + 0.2 * typedGap
+
+		threshold = ( self._scanGap * self._typedGap ) ** 0.5
+		self._threshold = min( max( threshold, 0.005 ), self._cfg.burstGap )
+
+# SerialBarcodeReader polls a scanner attached as a serial device. Such
+# scanners send each barcode as a whole line, so no timing is needed; the
+# line is checked for length and checksum and handed to onScan.
+class SerialBarcodeReader( object ):
+	def __init__( self, root, scannerConfig, onScan, onReject ):
+		self._root = root
+		self._cfg = scannerConfig
+		self._onScan = onScan
+		self._onReject = onReject
+		self._buf = ''
+
+		try:
+			import serial
+			self._conn = serial.Serial( scannerConfig.port, scannerConfig.baud, timeout=0 )
+		except:
+			print "Error opening barcode scanner port:", sys.exc_info()[0]
+			self._conn = None
+			return
+
+		self.Poll()
+
+	def Poll( self ):
+		try:
+			bytesToRead = self._conn.inWaiting()
+			if bytesToRead > 0:
+				self._buf += self._conn.read( bytesToRead )
+		except:
+			print "Barcode scanner connection broken:", sys.exc_info()[0]
+			return
+
+		while(( '\r' in self._buf ) or ( '\n' in self._buf )):
+			line, self._buf = re.split( '[\r\n]', self._buf, 1 )
+			code = line.strip()
+			if( code == '' ):
+				continue
+			if(( len( code ) < self._cfg.minLen ) or ( len( code ) > self._cfg.maxLen )):
+				self._onReject( code, 'length %d not in %d-%d' % ( len( code ), self._cfg.minLen, self._cfg.maxLen ))
+			elif( not BARCODE_CHECKSUMS[ self._cfg.checksum ]( code )):
+				self._onReject( code, self._cfg.checksum + ' checksum failed' )
+			else:
+				self._onScan( code )
+
+		self._root.after( 50, self.Poll )
+
 class LoginControl( object ):
-        def __init__( self, root, loaderControl, m1Control, m2Control, logFileName, barcodeLen ):
+        def __init__( self, root, loaderControl, m1Control, m2Control, logFileName, scannerConfig ):
 		self._logFileName = logFileName
 
                 lfrm = LabelFrame( root, text='Log Control', padx=10, pady=10, borderwidth=0 )
@@ -318,7 +729,6 @@ class LoginControl( object ):
                 self.entryOper = Entry( lfrmOper, textvariable=self._operVar, font=( 'Calibri', 12 ))
 
 		self._accessionVar = StringVar()
-		self._accessionVar.trace( 'w', self._HandleAccession )
 		self._accessionConfVar = StringVar()
 		self._accessionConfVar.trace( 'w', self._HandleAccessionConf )
 
@@ -331,7 +741,6 @@ class LoginControl( object ):
                 self.entryAccessionConf = Entry( lfrmAcc, width="14", textvariable=self._accessionConfVar, font=( 'Calibri', 12 ))
 
 		self._sampleVar = StringVar()
-		self._sampleVar.trace( 'w', self._HandleSample )
 		self._sampleConfVar = StringVar()
 		self._sampleConfVar.trace( 'w', self._HandleSampleConf )
 
@@ -373,58 +782,71 @@ class LoginControl( object ):
                 btnEdit.grid ( row=0, column=1 )
                 btnClear.grid( row=0, column=2 )
 
-		self._barcodeLen = barcodeLen
-		self._arrivalTime = [None] * barcodeLen
+		self._accessionScanner = BarcodeScanner( root, scannerConfig, self._HandleAccession,
+			lambda code, reason: self._RejectScan( 'accession', self._accessionVar, self.entryAccession, code, reason ))
+		self._sampleScanner = BarcodeScanner( root, scannerConfig, self._HandleSample,
+			lambda code, reason: self._RejectScan( 'sample', self._sampleVar, self.entrySample, code, reason ))
+		self.entryAccession.bind( '<KeyPress>', self._accessionScanner.OnKey )
+		self.entrySample.bind( '<KeyPress>', self._sampleScanner.OnKey )
+
+		# rejected scans turn the entry this colour until something is typed into it
+		self._entryBg = self.entryAccession.cget( 'background' )
+		self.entryAccession.bind( '<KeyPress>', lambda e: self.entryAccession.configure( background=self._entryBg ), '+' )
+		self.entrySample.bind( '<KeyPress>', lambda e: self.entrySample.configure( background=self._entryBg ), '+' )
+
+		if( scannerConfig.port != None ):
+			self._serialScanner = SerialBarcodeReader( root, scannerConfig, self._HandleSerialScan,
+				lambda code, reason: self._LogRejectedScan( 'serial', code, reason ))
 
                 self.entryOper.focus_set()
 
-	def _HandleAccession( self, *dummy ):
-		accessionStr = self._accessionVar.get()
-		arrivalIndex = len( accessionStr ) - 1
-
-		# see if this is the first character arriving in the entry widget
-		if arrivalIndex == 0:
-			# this is the first character arriving in the entry widget,
-			# so initialize the arrivalTime array
-			arrivalTime = [None] * self._barcodeLen
-
-		if arrivalIndex >= 0 and arrivalIndex < self._barcodeLen:
-			self._arrivalTime[ arrivalIndex ] = timeit.default_timer()
-
-		if arrivalIndex == self._barcodeLen - 1:
-			# see if a scanner was used to enter the accession number
-			if (( self._arrivalTime[ self._barcodeLen - 1 ] - self._arrivalTime[ 0 ]) < 0.25 ):
-				# looks as though a scanner was used to enter the accession number
-				# disable the accession number confirmation entry widget and 
-				# transfer focus to the sample id entry widget
-				self._accessionConfVar.set( self._accessionVar.get( ))
-				self.entrySample.focus_set( )
+	def _HandleAccession( self, barcode ):
+		# a scanner was used to enter the accession number, so fill in
+		# the confirmation and transfer focus to the sample id entry widget
+		self._accessionVar.set( barcode )
+		self._accessionConfVar.set( barcode )
+		self.entrySample.focus_set( )
+
+	def _RejectScan( self, fieldName, var, entry, code, reason ):
+		# the scan was misread, so take out what the scanner typed (keeping
+		# anything entered before it), flag the entry so the operator knows
+		# to rescan, and log it
+		text = var.get()
+		if( text.endswith( code )):
+			var.set( text[ :len( text ) - len( code ) ] )
+		entry.configure( background='#f4a0a0' )
+		entry.focus_set( )
+
+		self._LogRejectedScan( fieldName, code, reason )
+
+	def _LogRejectedScan( self, fieldName, code, reason ):
+		logEntry = ''.join([
+			datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+			" rejected ", fieldName, " scan=", code, " (", reason, ")" ])
+
+		with open(self._logFileName, 'a') as logFile:
+			print >>logFile, logEntry
 
 	def _HandleAccessionConf( self, *dummy ):
 		#print 'accession confirmation: ', self._accessionConfVar.get()
 		pass
 
-	def _HandleSample( self, *dummy ):
-		sampleStr = self._sampleVar.get()
-		arrivalIndex = len( sampleStr ) - 1
-
-		# see if this is the first character arriving in the entry widget
-		if arrivalIndex == 0:
-			# this is the first character arriving in the entry widget,
-			# so initialize the arrivalTime array
-			arrivalTime = [None] * self._barcodeLen
-
-		if arrivalIndex >= 0 and arrivalIndex < self._barcodeLen:
-			self._arrivalTime[ arrivalIndex ] = timeit.default_timer()
-
-		if arrivalIndex == self._barcodeLen - 1:
-			# see if a scanner was used to enter the sample ID
-			if (( self._arrivalTime[ self._barcodeLen - 1 ] - self._arrivalTime[ 0 ]) < 0.25 ):
-				# looks as though a scanner was used to enter the accession number
-				# disable the accession number confirmation entry widget and 
-				# transfer focus to the sample id entry widget
-				self._sampleConfVar.set( self._sampleVar.get( ))
-				self.entryOper.focus_set( )
+	def _HandleSample( self, barcode ):
+		# a scanner was used to enter the sample id, so fill in the
+		# confirmation and transfer focus back to the operator entry widget
+		self._sampleVar.set( barcode )
+		self._sampleConfVar.set( barcode )
+		self.entryOper.focus_set( )
+
+	def _HandleSerialScan( self, barcode ):
+		# a serial scanner doesn't type into a widget, so the barcode goes
+		# to the sample id once the accession number has been entered
+		if( self.entryAccession.cget( 'state' ) != 'normal' ):
+			return
+		if(( self._accessionVar.get() == "" ) or ( self.entryAccession.focus_get() in ( self.entryAccession, self.entryAccessionConf ))):
+			self._HandleAccession( barcode )
+		else:
+			self._HandleSample( barcode )
 
 	def _HandleSampleConf( self, *dummy ):
 		#print 'sample id confirmation: ', self._sampleConfVar.get()
@@ -442,7 +864,10 @@ class LoginControl( object ):
 			print >>logFile, logEntry
 
 	def onClearButtonClick( self, loaderControl, m1Control, m2Control ):
-		self._arrivalTime = [None] * self._barcodeLen
+		self._accessionScanner.Reset()
+		self._sampleScanner.Reset()
+		self.entryAccession.configure( background=self._entryBg )
+		self.entrySample.configure( background=self._entryBg )
 
 		self._sampleVar.set("")
 		self._sampleConfVar.set("")
@@ -463,7 +888,10 @@ class LoginControl( object ):
                 self.entryOper.focus_set()
 
 	def onEditButtonClick( self, loaderControl, m1Control, m2Control ):
-		self._arrivalTime = [None] * self._barcodeLen
+		self._accessionScanner.Reset()
+		self._sampleScanner.Reset()
+		self.entryAccession.configure( background=self._entryBg )
+		self.entrySample.configure( background=self._entryBg )
 
                 loaderControl.Disable()
 		m1Control.Disable()
@@ -644,10 +1072,10 @@ class TraceControl( object ):
 		self._textwidget.delete( '1.0', END )
 		self._textwidget.config( state='disabled' )
 
-def BuildUI( tkRoot, arduinoCmds, logFileName, debug ):
+def BuildUI( tkRoot, arduinoCmds, logFileName, debug, profiler ):
 	frm = Frame( tkRoot, padx=10, pady=10 )
 
-	arduinoLink = ArduinoLink( frm, arduinoCmds, logFileName, debug )
+	arduinoLink = ArduinoLink( frm, arduinoCmds, logFileName, debug, profiler )
 
 	loaderControl = LoaderControl( frm, arduinoCmds, arduinoLink )
 	loaderControl.Disable()
@@ -658,7 +1086,7 @@ def BuildUI( tkRoot, arduinoCmds, logFileName, debug ):
 	m2Control = MotorControl2( frm, arduinoCmds, arduinoLink )
 	m2Control.Disable()
 
-	loginControl = LoginControl( frm, loaderControl, m1Control, m2Control, logFileName, int( arduinoCmds["barcodeLen"] ))
+	loginControl = LoginControl( frm, loaderControl, m1Control, m2Control, logFileName, ScannerConfig( arduinoCmds ))
 	loaderControl.setLoginControl( loginControl )
 
 	appControl   = AppControl( frm, arduinoCmds, arduinoLink )
@@ -666,6 +1094,29 @@ def BuildUI( tkRoot, arduinoCmds, logFileName, debug ):
 	frm.grid( row=0, column=0, sticky=W )
 
 	arduinoLink.InitializeUiStateControl( loaderControl, m1Control, m2Control )
+	profiler.Mark( 'build widgets' )
+
+	# the load controls stay disabled until the operator logs in, so the
+	# profiles can wait until Tk has laid out and mapped the window. Failing to
+	# load them is still fatal, as it was when they were read up front.
+	def FinishStartup( ):
+		try:
+			loaderControl.LoadProfiles()
+		except:
+			ShowError("Error", "Can't load motor profiles")
+			sys.exit( 1 )
+		profiler.Mark( 'load psdProfiles' )
+
+	tkRoot.after_idle( FinishStartup )
+
+	# the first Expose on the frame is when the window is actually drawn;
+	# it is only used for profiling, since a window that starts iconified
+	# or covered may not be exposed for a long time
+	def OnFirstExpose( event ):
+		frm.unbind( '<Expose>', exposeId )
+		profiler.Mark( 'first paint' )
+
+	exposeId = frm.bind( '<Expose>', OnFirstExpose )
 	return frm
 
 def LoadArduinoCommands( ):
@@ -684,10 +1135,12 @@ class RunTimeConfig( object ):
 		parser = OptionParser()
 		parser.add_option( '-l', '--logfile', dest='logfilename', action='store', default='/var/log/psd.log', help='log file' )
 		parser.add_option( '-d', '--debug', dest='debug', action='store_true', default=False, help='debug mode' )
+		parser.add_option( '--profile-startup', dest='profilestartup', action='store_true', default=False, help='report time spent in each startup phase' )
 		(options, args) = parser.parse_args()
 
 		self._logfilename = options.logfilename
 		self._debug = options.debug
+		self._profileStartup = options.profilestartup
 
 	def LogFileName( self ):
 		return self._logfilename
@@ -695,7 +1148,19 @@ class RunTimeConfig( object ):
 	def Debug( self ):
 		return self._debug
 
+	def ProfileStartup( self ):
+		return self._profileStartup
+
 config = RunTimeConfig()
-root = BuildUI( Tk( ), LoadArduinoCommands(), config.LogFileName(), config.Debug() )
+profiler = StartupProfiler( config.ProfileStartup() )
+profiler.Mark( 'imports' )
+
+tkRoot = Tk( )
+profiler.Mark( 'Tk init' )
+
+arduinoCmds = LoadArduinoCommands()
+profiler.Mark( 'load psdCommands' )
+
+root = BuildUI( tkRoot, arduinoCmds, config.LogFileName(), config.Debug(), profiler )
 root.mainloop()
 